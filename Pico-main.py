@@ -1,17 +1,50 @@
 """Code compiled by Isaac Mantelli based on public sources."""
 
 from mqtt_async import MQTTClient, config
+import array
 import asyncio
+import gc
+import micropython
+import time
 from machine import ADC, Pin
+from micropython import const
+
+# Collect garbage early and often (once a quarter of the free heap has been
+# allocated) so the small Pico heap doesn't fragment between collections
+gc.threshold(gc.mem_free() // 4)
 
 pico_name = "pico1"
+TOPIC1 = f'soilmoisture/{pico_name}/sensor1/batch'.encode() # built once, not on every publish
 led = Pin("LED", Pin.OUT) # Initialize the onboard LED
 
+# Pin numbers and fixed settings are const() so MicroPython compiles them straight
+# into the code. The leading underscore keeps them out of the module's globals.
+_PIN_RELAY = const(18) # water pump relay
+_PIN_SOIL1 = const(26) # first soil moisture sensor
+_PIN_BUTTON_0 = const(14) # green calibration button (0% moisture)
+_PIN_BUTTON_100 = const(15) # blue calibration button (100% moisture)
+
 # HUM_TEMP = Pin(2, Pin.IN) # Define the humidity/temperature sensor
-relay = Pin(18, Pin.OUT) # Define the location and behavior of the water pump relay
-SOIL1 = ADC(Pin(26)) # Define the location of the first soil moisture sensor
-HI_ADC = 48600 # Initialize the 'dry' ADC reading
-LO_ADC = 19400 # Initialize the 'wet' ADC reading
+relay = Pin(_PIN_RELAY, Pin.OUT) # Define the location and behavior of the water pump relay
+SOIL1 = ADC(Pin(_PIN_SOIL1)) # Define the location of the first soil moisture sensor
+# Calibration values live in one small array, so the calibration functions can
+# update them in place (no `global` needed) and read_sensor can index them directly.
+_CAL_HI = const(0) # 'dry' ADC reading
+_CAL_LO = const(1) # 'wet' ADC reading
+_CAL_SPAN = const(2) # dry minus wet, kept up to date by the calibration functions below
+_CAL = array.array('i', (48600, 19400, 48600 - 19400)) # Initialize the calibration values
+# Change these values depending on personal testing.
+_PUMP_HI = const(60) # Turn the pump off once moisture rises above this %
+_PUMP_LO = const(30) # Turn the pump on once moisture drops below this %
+
+# Readings are collected here and sent to the Pi together in one publish
+_batch = [] # (time in ms, moisture %) pairs waiting to be published
+_batch_ready = asyncio.Event() # set by measure_moisture when the batch should be sent
+_BATCH_MAX = const(8) # publish once this many readings have been collected...
+_BATCH_MS = const(5000) # ...or once the oldest reading is this many ms old
+_BATCH_LIMIT = const(32) # if publishing stalls, drop the oldest readings past this many
+_PUBLISH_DELTA = const(2) # only send a reading once it has moved by at least this many %...
+_PUBLISH_MAX_MS = const(60000) # ...or once this many ms have passed since the last one sent
 
 # Set up the connection to the Raspberry Pi WiFi hotspot
 config['ssid'] = 'nmsba-ap'
@@ -26,7 +59,8 @@ async def up(client): # respond to connectivity being (re)established
         await client.up.wait() # wait on event
         client.up.clear()
 
-def read_sensor(sensor, sensor_high_value, sensor_low_value):
+@micropython.viper
+def read_sensor(read, cal) -> int:
     """Read a sensor and convert the raw ADC value to a 'human-readable' percentage.
     This is the main function that most of the script is based on.
     Uses two lines of code from the micropython docs:
@@ -35,19 +69,24 @@ def read_sensor(sensor, sensor_high_value, sensor_low_value):
     (see: docs.micropython.org/en/latest/library/machine.ADC.html)
     
     Definitions of arguments:
-    -sensor: name of ADC input defined at the top (for example, SOIL1)
-    -sensor_high_value = highest ADC value, associated with sensor reading in air (dry)
-    -sensor_low_value = lowest ADC value, associated with sensor reading in water (wet)
+    -read: read_u16 method of an ADC input defined at the top (for example, SOIL1.read_u16),
+     looked up once by the caller so it isn't re-resolved on every reading
+    -cal: calibration array defined at the top (_CAL), holding the highest ADC value
+     (sensor in air, dry), the lowest ADC value (sensor in water, wet) and their difference
+    
+    Integer division (//) keeps the math off the Pico's software floating point,
+    and the viper decorator compiles this function to machine code working on
+    plain integers (see: docs.micropython.org/en/latest/reference/speed_python.html).
     """
-    percent = int(((sensor_high_value - sensor.read_u16()) * 100) \
-              /(sensor_high_value - sensor_low_value))
-    return percent
+    c = ptr32(cal)
+    raw = int(read())
+    return ((c[_CAL_HI] - raw) * 100) // c[_CAL_SPAN]
 
 
 """For the following two functions:
     Use buttons on the Pico's breadboard to get the extreme values of 0% moisture
     (i.e., holding the sensor in the air) and 100% moisture (i.e., placing the
-    sensor's tip in water). These values will be saved to the HI_ADC and LO_ADC variables
+    sensor's tip in water). These values will be saved to the _CAL array
     defined at the top of the code to calibrate the read_sensor function defined previously.
     For ease, 0% and 100% calibration functions have been split up.
     
@@ -62,53 +101,140 @@ def read_sensor(sensor, sensor_high_value, sensor_low_value):
 """
 
 from picozero import Button
-button_calibrate_0_per = Button(14) # Green button connected to pin 14
-button_calibrate_100_per = Button(15) # Green button connected to pin 15
+button_calibrate_0_per = Button(_PIN_BUTTON_0) # Green button connected to pin 14
+button_calibrate_100_per = Button(_PIN_BUTTON_100) # Blue button connected to pin 15
 
 def calibrate_sensor_0(sensor):
     """Define the function that will apply to the green button and define '0% moisture'.
-    Calls the global variable HI_ADC and assigns it a new value from a dry sensor reading.
+    Stores a new 'dry' value from a dry sensor reading in the _CAL array.
     
     Definition of argument:
     -sensor: name of ADC input defined at the top (the sensor we want to calibrate)
     """
-    global HI_ADC # tell the function that we are reading a global variable
-    HI_ADC = sensor.read_u16() # Use the normal method for reading a moisture sensor
+    _CAL[_CAL_HI] = sensor.read_u16() # Use the normal method for reading a moisture sensor
+    _CAL[_CAL_SPAN] = _CAL[_CAL_HI] - _CAL[_CAL_LO]
 
 def calibrate_sensor_100(sensor):
     """Define the function that will apply to the blue button and define '100% moisture'.
-    Calls the global variable LO_ADC and assigns it a new value from a wet sensor reading.
+    Stores a new 'wet' value from a wet sensor reading in the _CAL array.
     
     Definition of argument:
     -sensor: name of ADC input defined at the top (the sensor we want to calibrate)
     """
-    global LO_ADC # tell the function that we are reading a global variable
-    LO_ADC = sensor.read_u16() # Use the normal method for reading a moisture sensor
+    _CAL[_CAL_LO] = sensor.read_u16() # Use the normal method for reading a moisture sensor
+    _CAL[_CAL_SPAN] = _CAL[_CAL_HI] - _CAL[_CAL_LO]
 
 button_calibrate_0_per.when_pressed = calibrate_sensor_0
 button_calibrate_100_per.when_pressed = calibrate_sensor_100
 
 async def measure_moisture(sensor1):
     """ Use the first function we defined to read soil moisture sensors.
-    Every 30 seconds, take a new reading from any enabled sensors and publish 
-    the value to the associated topic. The Pi on the other end will receive 
-    that value and be able to display it.
+    Every second, take a new reading from any enabled sensors. If it has moved
+    by at least _PUBLISH_DELTA % since the last reading sent (or the pump just
+    switched), add it to the batch. A steady reading is still sent once every
+    _PUBLISH_MAX_MS, so the Pi keeps logging and catches up after a restart.
+    Once the batch is full (or old enough), signal publish_moisture
+    to send it. This function never waits on the network, so a slow publish
+    can't delay the next reading.
     
-    See Paho's PyPi docs for the original text of client.publish(...).
+    The same reading also drives the water pump relay, so the sensor is only
+    read once per second for both jobs. The pump turns on below _PUMP_LO
+    and stays on until moisture rises above _PUMP_HI.
     
     Definitions of arguments:
     -sensor1: name of first ADC input defined at the top of the code
     """
+    # Look up these methods once here instead of on every pass through the loop
+    read = sensor1.read_u16
+    set_relay = relay.value
+    sleep = asyncio.sleep
+    ticks_ms = time.ticks_ms
+    ticks_diff = time.ticks_diff
+    append = _batch.append
+    ready = _batch_ready.set
+
+    batch_start = ticks_ms()
+    last_published = None
+    last_sent = ticks_ms()
+    relay_state = set_relay() # calling value() with no argument reads the pin
+    while True:
+        await sleep(1) # measure moisture every n seconds.
+        moisture1 = read_sensor(read, _CAL)
+        # Turn on the pump relay if the moisture is too low. Turn off when sufficiently high.
+        pump_on = relay_state
+        if moisture1 < _PUMP_LO:
+            pump_on = 1
+        elif moisture1 > _PUMP_HI:
+            pump_on = 0
+        now = ticks_ms()
+        if pump_on != relay_state or last_published is None \
+           or abs(moisture1 - last_published) >= _PUBLISH_DELTA \
+           or ticks_diff(now, last_sent) >= _PUBLISH_MAX_MS:
+            if pump_on != relay_state:
+                set_relay(pump_on)
+                relay_state = pump_on
+            last_published = moisture1
+            last_sent = now
+            if not _batch:
+                batch_start = now
+            append((now, moisture1))
+            if len(_batch) > _BATCH_LIMIT:
+                _batch.pop(0) # publishing has fallen behind, so drop the oldest reading
+        if _batch and (len(_batch) >= _BATCH_MAX or ticks_diff(now, batch_start) >= _BATCH_MS):
+            ready()
+
+def encode_batch(batch):
+    """Turn a list of (time in ms, moisture %) readings into one payload of
+    "time:value" pairs. Only the first reading carries its full ticks_ms()
+    time; each later one carries the ms since the reading before it. A full
+    timestamp can be 10 digits, while the gap between readings is usually
+    about 1000, so this keeps the payload short, e.g. b"1073741823:45,1001:46".
+    (mqtt_async only speaks MQTT 3.1.1, so MQTT 5 topic aliases can't be used
+    to shrink the topic instead.)
+    
+    Definition of argument:
+    -batch: list of (time in ms, moisture %) pairs, oldest first
+    """
+    ticks_diff = time.ticks_diff
+    parts = []
+    previous = batch[0][0]
+    for t, v in batch:
+        parts.append(b"%d:%d" % (ticks_diff(t, previous) if parts else t, v))
+        previous = t
+    return b",".join(parts)
+
+async def publish_moisture(client):
+    """Wait for measure_moisture to signal that a batch is ready, then publish
+    all of its readings at once to the associated topic (see encode_batch).
+    The Pi on the other end will receive the batch and display the newest value.
+    
+    See Paho's PyPi docs for the original text of client.publish(...).
+    
+    Definition of argument:
+    -client: the MQTT client connected to the Pi
+    """
+    # Look up these methods once here instead of on every pass through the loop
+    publish = client.publish
+    wait = _batch_ready.wait
+    clear = _batch_ready.clear
+
     while True:
-        await asyncio.sleep(1) # measure moisture every n seconds.
-        moisture1 = read_sensor(SOIL1, HI_ADC, LO_ADC)
-        await client.publish(f'soilmoisture/{pico_name}/sensor1', f'{moisture1}', qos = 1)
+        await wait()
+        clear()
+        payload = encode_batch(_batch)
+        _batch.clear()
+        # QoS 0 skips waiting on a PUBACK from the Pi for every batch. A lost
+        # batch only delays the Pi, since a fresh one follows within _PUBLISH_MAX_MS.
+        await publish(TOPIC1, payload, qos = 0)
+        del payload
+        gc.collect() # A publish is a safe, infrequent point to tidy up the heap
 
 
 """The following block of code is an example of using the MQTT protocol to subscribe to a
 topic that the Raspberry Pi publishes to. In theory, the Pi could publish new min/max
 bounds for the water pump to turn on/off, and here the Pico would receive those messages
-and update the global pump bound variables defined above. Code is taken from the mqtt_async
+and update the pump bounds defined above (which would then have to become ordinary
+variables again instead of const() values). Code is taken from the mqtt_async
 official docs and is currently commented out for continued testing."""
 # async def change_pump_bounds(client, pico_name):
 #     await client.subscribe(f'pump/{pico_name}/upper_bound', qos=1)
@@ -121,16 +247,16 @@ async def main(client):
     If the connection is successful, the LED on the Pico will turn on to confirm
     everything is working.
     
-    Then, use an asyncio Task Group to queue up the main functions in our code
-    (measure_moisture, pump_relay). See the official Python docs for more information:
-    docs.python.org/3/library/asyncio-task.html (Section "Task Groups")
+    Then, use asyncio.gather to run the main functions in our code side by side
+    (measure_moisture, publish_moisture, up). MicroPython's asyncio has gather but
+    no Task Groups. See the MicroPython docs for more information:
+    docs.micropython.org/en/latest/library/asyncio.html
     """
     await client.connect() # Try to connect to the hotspot...
     led.on() # ...and turn on the LED if successful.
+    gc.collect() # Start the main loop with a clean heap now that setup is done
 
-    async with asyncio.Taskgroup() as tg:
-        task1 = tg.create_task(measure_moisture(SOIL1))
-        task2 = tg.create_task(pump_relay(SOIL1, HI_ADC, LO_ADC))
+    await asyncio.gather(measure_moisture(SOIL1), publish_moisture(client), up(client))
     
 config['queue_len'] = 1
 MQTTClient.DEBUG = True
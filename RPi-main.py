@@ -12,19 +12,24 @@ For more information on both modules, see:
 """
 
 import paho.mqtt.client as mqtt
-import csv 
+import array
+import queue
+import socket
+import threading
+import time
 from datetime import datetime
 from gpiozero import DigitalOutputDevice
 
-from tkinter import *
+import tkinter as tk
 from tkinter import ttk
 
 relay = DigitalOutputDevice(18) # Define the location of the pin that controls the relay
 broker_address = '10.42.0.1' # this is the IP address of the RPi 4
-client = mqtt.Client('Pi4') # this is the username of the RPi 4
+client_id = 'Pi4' # this is the username of the RPi 4
+sensor_topics = ['soilmoisture/+/sensor1/batch'] # what to listen to (+ matches any Pico name)
 csv_filepath = '/home/pi4/Documents/moisture_logs/1.csv' # where to save the data
 
-class App(Frame):
+class App(tk.Frame):
 	"""The OOP wrapper is derived from the Python docs section titled 
 	"Important Tk Concepts." The tk "main loop" (expressed at the end of
 	the code as app.mainloop()) is the topmost level of the code, while 
@@ -37,93 +42,349 @@ class App(Frame):
 	sources listed above. MQTT code from PyPi has been modified (mostly
 	by simply adding self.xxxx) to work it into the class structure.
 	 """
-	def __init__(self, root, client, address, filepath):
+	def __init__(self, root, address, filepath, topics=sensor_topics, name=client_id):
 		super().__init__(root)
-		self.current_moisture = str(50) # added attribute 
-		self.readback = Text(root, width=40, height=10)
+		self.current_moisture = '50' # added attribute 
+		self.moisture = 50 # current_moisture as a number
+		self.last_reading = None # newest valid reading, to spot repeats
+		self.readback_format = 'Soil moisture: {}%'.format # the fixed text is only parsed once
+		self.readback_text = tk.StringVar(value=self.readback_format(self.current_moisture))
+		self.readback = ttk.Label(root, textvariable=self.readback_text,
+			font=('Calibri', 20, 'bold'), anchor='center', justify='center')
 		self.readback.grid()
-		self.readback.tag_add('moisture','1.0','2.0')
-		self.readback.tag_configure(
-			'moisture',font=('Calibri', 20, 'bold'),justify='center'
-		)
-		self.csv_record_time = 0
+		self.csv_record_time = float('-inf') # time.monotonic() of the last csv row
+		self.csv_record_interval = 60.0 # seconds between csv rows
 		# Change these values depending on personal testing.
 		self.pump_upper_bound = 60
 		self.pump_lower_bound = 30
+
+		# Keep the last history_len readings in a fixed-size ring buffer of
+		# C ints, ready for plotting later without converting from strings.
+		self.history_len = 600
+		self.history = array.array('i', [0]) * self.history_len
+		self.history_index = 0 # where the next reading will be written
+		self.history_count = 0 # how many slots hold real readings
 		
-		# work in the MQTT client and callbacks
-		self.client = client
+		# work in the MQTT client and callbacks. Each App has its own client
+		# (and so its own connection), which lets spawn() split the sensors
+		# between several clients.
+		self.client = mqtt.Client(client_id=name, protocol=mqtt.MQTTv5)
 		self.address = address
+		self.topics = list(topics)
 		self.client.on_message = self.on_message
+		for topic in self.topics:
+			self.client.message_callback_add(topic, self.on_sensor1)
 		self.client.on_connect = self.on_connect
-		self.client.connect(address)
+		# Paho runs on the Tk thread, so an exception escaping a callback would
+		# leave it re-reading the same packet forever; log and carry on instead.
+		self.client.suppress_exceptions = True
+		self.client.on_disconnect = self.on_disconnect
+		# Paho runs inside the Tk event loop (see startmqtt), so these tell
+		# Tk which broker socket to watch, and for reading or writing
+		self.client.on_socket_open = self.on_socket_open
+		self.client.on_socket_close = self.on_socket_close
+		self.client.on_socket_register_write = self.on_socket_register_write
+		self.client.on_socket_unregister_write = self.on_socket_unregister_write
+		self.mqtt_misc_ms = 1000 # how often Paho gets to send keepalive pings
+		# Don't connect yet: startmqtt() does that from the Tk event loop, and
+		# failed attempts are retried after 1, 2, 4, ... up to 30 seconds.
+		# Opening the connection still blocks the GUI until it succeeds or
+		# times out, so cut Paho's 5 s timeout (it has no setter in 1.x)
+		# to 1 s; the broker is on the local hotspot, so that is plenty.
+		self.client._connect_timeout = 1.0
+		self.reconnect_min_delay = 1
+		self.reconnect_max_delay = 30
+		self.reconnect_delay = self.reconnect_min_delay
+		self.client.connect_async(address)
 		self.filepath = filepath
 
+		# Keep the csv file open instead of reopening it for every row. Rows
+		# are handed to a background thread through csv_queue, so a slow SD
+		# card write never holds up the GUI. Close it when the window closes.
+		# Each row is just two plain fields, so it is opened in binary mode and
+		# rows are written as ready-made bytes instead of through csv.writer.
+		self.csvfile = open(filepath, 'ab', buffering=1 << 16)
+		self.csv_queue = queue.Queue()
+		self.csv_thread = threading.Thread(target=self.csv_worker, daemon=True)
+		self.csv_thread.start()
+		root.protocol('WM_DELETE_WINDOW', self.close)
+
+		# Redraw the readback at most every refresh_ms (10 times a second),
+		# and only if a new reading arrived since the last redraw.
+		self.readback_dirty = False
+		self.refresh_ms = 100
+		self.after(self.refresh_ms, self.refresh_readback)
+
 	# The following two functions are used to 
 	def update_readback(self):
-		"""Uses code from tkdocs to first delete the original soil
-		moisture value and then replace it with the new value.
-		(See: tkdocs.com/tutorial/text.html, sections "The Basics" and
-		"Deleting Text".)
+		"""Uses code from tkdocs to replace the soil moisture value shown
+		in the label. Setting the label's StringVar is a single update, so
+		the label doesn't need to be cleared first.
+		(See: tkdocs.com/tutorial/widgets.html, section "Label".)
 		"""
-		self.readback.delete('1.0','2.0')
-		self.readback.insert('1.0',
-			'Soil moisture: ' + self.current_moisture + '%',
-			('moisture'))
+		self.readback_text.set(self.readback_format(self.current_moisture))
 
 	def record_to_csv(self, data):
 		"""Write moisture readings to the csv file defined at the top.
-  		Code based on the official Python docs for the CSV module:
-    		https://docs.python.org/3/library/csv.html
-      		(As needed, Monty Python references have been scrubbed here)
+		Each line is "time,moisture", with the time as yymmddHHMM
+		(year, month, day, hour, and minute), e.g. b"2410151230,45".
+		Rows are only queued here; csv_worker() writes them to the file.
+		
+		Definition of argument:
+		-data: moisture reading as an int
+		"""
+		current_time = datetime.now().strftime('%y%m%d%H%M').encode('ascii')
+		self.csv_queue.put_nowait(b'%s,%d\n' % (current_time, data)) # each line has time and moisture
+
+	def refresh_readback(self):
+		"""Runs every refresh_ms. Redraw the readback only if a reading has
+		arrived since the last redraw, so bursts of messages cost one update.
+		While the window is minimized the label isn't viewable, so skip the
+		redraw and leave it marked out of date; it catches up on the first
+		tick after the window is shown again.
+		"""
+		if self.readback_dirty and self.readback.winfo_viewable():
+			self.readback_dirty = False
+			self.update_readback()
+			# Paint now, once per refresh window, rather than whenever Tk next
+			# goes idle. update_idletasks() doesn't process other events, so
+			# unlike update() it can't re-enter this callback.
+			self.readback.update_idletasks()
+		self.after(self.refresh_ms, self.refresh_readback)
+
+	def recent_readings(self):
+		"""Return the readings in the history ring buffer, oldest first,
+		as an array.array of ints (e.g. for plotting with matplotlib).
+		There is one entry per reading the Pico sent. The Pico skips steady
+		readings (see measure_moisture in Pico-main.py), so the entries
+		aren't evenly spaced in time.
+		"""
+		if self.history_count < self.history_len:
+			return self.history[:self.history_count]
+		return self.history[self.history_index:] + self.history[:self.history_index]
+
+	def csv_worker(self):
+		"""Runs on its own thread. Wait for rows from record_to_csv(), take
+		any others that are already queued too, and write them all at once
+		before flushing the file. A None in the queue means the app is
+		closing: write what is left, close the file and stop.
+		(See: docs.python.org/3/library/queue.html)
 		"""
-		current_time = datetime.now().strftime('%y%m%d%H%M') # Format a string for the year, month, day, hour, and minute
-		with open(self.filepath, 'a', newline='', encoding='utf-8') as csvfile:
-			writer = csv.writer(csvfile)
-			writer.writerow([current_time, data]) # each line has time and moisture
+		running = True
+		while running:
+			rows = [self.csv_queue.get()]
+			while True:
+				try:
+					rows.append(self.csv_queue.get_nowait())
+				except queue.Empty:
+					break
+			if None in rows:
+				running = False
+				rows = [row for row in rows if row is not None]
+			self.csvfile.write(b''.join(rows))
+			self.csvfile.flush()
+		self.csvfile.close()
+
+	def shutdown(self):
+		"""Stop MQTT and save any buffered csv rows."""
+		self.client.disconnect()
+		# disconnect() only queues the DISCONNECT packet for Tk to send once
+		# the socket is writable, but the window is about to close, so send it
+		# now to let the broker see a clean disconnect.
+		self.client.loop_write()
+		self.csv_queue.put(None) # tell csv_worker() to finish up...
+		self.csv_thread.join() # ...and wait until the file is closed
+
+	def close(self):
+		"""Runs when the window is closed: shut down, then close the window."""
+		self.shutdown()
+		self.master.destroy()
+
+	@classmethod
+	def spawn(cls, root, address, shards):
+		"""Create one App per shard in the same window, each with its own MQTT
+		client and csv file, so the Picos can be split across several
+		connections instead of all sharing one.
+		
+		Definitions of arguments:
+		-root: the Tk instance
+		-address: IP address of the broker
+		-shards: list of (topic, filepath) pairs, e.g.
+		 [('soilmoisture/pico1/sensor1/batch', '.../1.csv'),
+		  ('soilmoisture/pico2/sensor1/batch', '.../2.csv')]
+		
+		All shards drive the same pump relay, so it follows whichever
+		shard's reading arrived last. Returns the list of Apps.
+		"""
+		apps = [cls(root, address, filepath, topics=[topic], name=f'{client_id}-{number}')
+			for number, (topic, filepath) in enumerate(shards, start=1)]
+
+		def close_all():
+			for app in apps:
+				app.shutdown()
+			root.destroy()
+		root.protocol('WM_DELETE_WINDOW', close_all)
+		return apps
 	
 	"""The following 8 lines are taken from the basic example provided
 	in the pypi.org source. There are three modifications:
-		1) The client subscribes to 'soilmoisture/#' (# means 'all').
-		2) The on_message function updates the current_moisture
-			attribute with the newly received sensor reading instead
-			of printing to the terminal as in the example. It also
-   			writes the current moisture reading to the csv file.
-		3) client.loop_forever() has been changed to client.loop_start()
-			to fit within the Tkinter main loop. The 'new' function 
-			startmqtt() helps cleanly start the connection.
+		1) The client subscribes only to the sensor batch topics, by
+			default 'soilmoisture/+/sensor1/batch' (+ matches any one level).
+		2) Sensor readings go to their own callback, on_sensor1, which
+			passes them to handle_reading() instead of printing to the
+			terminal as in the example. handle_reading() updates the
+			current_moisture attribute and writes it to the csv file.
+			on_message still prints anything else that arrives.
+		3) client.loop_forever() has been replaced by Paho's "external
+			event loop" callbacks (on_socket_open and friends), so the
+			Tkinter main loop itself reads and writes the MQTT socket and
+			no separate network thread is needed. The 'new' function 
+			startmqtt() helps cleanly start the connection, and
+			try_connect() keeps retrying (with a growing delay) if the
+			broker can't be reached or the connection drops.
    	"""	
-	def on_connect(self, client, userdata, flags, rc):
-		print(f'Connected with result code {rc}')
-		client.subscribe('soilmoisture/#')
+	def on_connect(self, client, userdata, flags, reasonCode, properties=None):
+		print(f'Connected with reason code {reasonCode}')
+		if reasonCode == 0:
+			# Only reset the backoff once the broker has accepted the session,
+			# not as soon as the TCP connection opens.
+			self.reconnect_delay = self.reconnect_min_delay
+			# QoS 0: the GUI only needs the latest reading, and the Pico sends a
+			# fresh batch within a minute even when the soil is steady.
+			client.subscribe([(topic, 0) for topic in self.topics])
 	
+	def on_disconnect(self, client, userdata, reasonCode, properties=None):
+		"""Log the disconnect and, unless we asked for it (reason code 0,
+		e.g. when the window closes), schedule a reconnect attempt.
+		"""
+		print(f'Disconnected with reason code {reasonCode}')
+		if reasonCode != 0:
+			self.retry_later()
+
+	def try_connect(self):
+		"""(Re)connect to the broker, or try again later if it can't be reached.
+		The backoff is only reset by on_connect, once the broker accepts us.
+		This blocks the GUI for up to the 1 s connect timeout set in __init__.
+		"""
+		try:
+			self.client.reconnect()
+		except OSError as err:
+			print(f'Could not reach the broker ({err})')
+			self.retry_later()
+
+	def retry_later(self):
+		"""Schedule try_connect() after reconnect_delay seconds, doubling the
+		wait each time up to reconnect_max_delay so a missing broker, one that
+		refuses the connection, or flaky Wi-Fi doesn't cause a storm of
+		connection attempts.
+		"""
+		print(f'Retrying in {self.reconnect_delay} s')
+		self.after(self.reconnect_delay * 1000, self.try_connect)
+		self.reconnect_delay = min(self.reconnect_delay * 2, self.reconnect_max_delay)
+
+	def on_socket_open(self, client, userdata, sock):
+		"""Paho calls this as soon as it opens the broker connection. Turn
+		off Nagle's algorithm so small MQTT packets are sent right away
+		instead of being held back to be combined with later ones.
+		"""
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.tk.createfilehandler(sock, tk.READABLE, self.on_socket_ready)
+
+	def on_socket_close(self, client, userdata, sock):
+		"""Stop watching the broker socket once Paho closes it."""
+		self.tk.deletefilehandler(sock)
+
+	def on_socket_register_write(self, client, userdata, sock):
+		"""Paho has data to send, so also wake up when the socket can be written."""
+		self.tk.createfilehandler(sock, tk.READABLE | tk.WRITABLE, self.on_socket_ready)
+
+	def on_socket_unregister_write(self, client, userdata, sock):
+		"""Everything has been sent, so go back to only watching for incoming data."""
+		self.tk.createfilehandler(sock, tk.READABLE, self.on_socket_ready)
+
+	def on_socket_ready(self, sock, mask):
+		"""Tk calls this when the broker socket can be read or written
+		(see: docs.python.org/3/library/tkinter.html, section "File Handlers").
+		Paho's loop_read() then handles any incoming messages right here on
+		the Tk thread, and loop_write() sends anything Paho has queued.
+		"""
+		if mask & tk.READABLE:
+			self.client.loop_read()
+		if mask & tk.WRITABLE:
+			self.client.loop_write()
+
+	def mqtt_misc(self):
+		"""Runs every mqtt_misc_ms so Paho can send keepalive pings and
+		notice a dead connection, which loop_read/loop_write don't cover.
+		"""
+		self.client.loop_misc()
+		self.after(self.mqtt_misc_ms, self.mqtt_misc)
+
 	def on_message(self, client, userdata, msg):
+		"""Catch-all for topics that have no callback of their own."""
+		print(f'Unhandled message on {msg.topic}: {msg.payload}')
+
+	def on_sensor1(self, client, userdata, msg):
+		"""Paho calls this only for soilmoisture/<pico>/sensor1/batch
+		messages (see message_callback_add in __init__). Paho runs on the Tk
+		thread, so the payload can be handled straight away.
+		"""
+		self.handle_reading(msg.payload)
+
+	def handle_reading(self, payload):
 		"""React to receiving a message from a subscribed topic by
-  		1) Updating the class attribute current_moisture to the message string;
-    		2) Use the function update_readback() defined above to modify the GUI;
+  		1) Adding every reading in the message (the Pico sends batches of
+		   "time:value" pairs) to the history ring buffer;
+		2) Updating the class attribute current_moisture to the newest reading
+		   and marking the GUI as out of date so refresh_readback() redraws it;
       		3) Write the current time and current moisture to the csv file;
 		4) Turn on/off the relay if soil moisture is low/high enough.
 		"""
-		self.current_moisture = msg.payload.decode("utf-8")
-		self.update_readback()
+		pairs = payload.split(b',')
+		try:
+			# Building the array checks every value fits a C int before any
+			# of them reach the history buffer.
+			values = array.array('i', [int(pair.rsplit(b':', 1)[-1]) for pair in pairs])
+		except (ValueError, OverflowError):
+			return # not a batch of moisture readings, so ignore it
+
+		history = self.history
+		history_len = self.history_len
+		index = self.history_index
+		for value in values:
+			history[index] = value
+			index = (index + 1) % history_len
+		self.history_index = index
+		self.history_count = min(self.history_count + len(values), history_len)
+
+		reading = values[-1] # newest reading
+		if reading != self.last_reading:
+			# Only redraw the GUI when the newest value changes
+			self.last_reading = reading
+			self.moisture = reading
+			self.current_moisture = str(reading) # the GUI uses the string
+			self.readback_dirty = True
+		moisture = self.moisture
 
-		# Record soil moisture to the csv only once a minute to save on storage
-		now_time = int(datetime.now().strftime('%y%m%d%H%M'))
-		if now_time - self.csv_record_time >= 1:
-			self.record_to_csv(self.current_moisture)
+		# Record soil moisture to the csv only once a minute to save on storage.
+		# A monotonic clock is cheaper than formatting the date on every message.
+		now_time = time.monotonic()
+		if now_time - self.csv_record_time >= self.csv_record_interval:
+			self.record_to_csv(moisture)
 			self.csv_record_time = now_time
 		
 		# Turn on the pump relay if the moisture is too low. Turn off when sufficiently high.
-		if self.current_moisture < self.pump_lower_bound:
+		if moisture < self.pump_lower_bound:
 			relay.on()
-		elif self.current_moisture >= self.pump_upper_bound:
+		elif moisture >= self.pump_upper_bound:
 			relay.off()
 
 	def startmqtt(self):
-		self.client.loop_start()
+		self.try_connect()
+		self.after(self.mqtt_misc_ms, self.mqtt_misc)
 
 	
-root = Tk() # Create a Tkinter instance
-app = App(root, client, broker_address, csv_filepath) # Create an App instance
+root = tk.Tk() # Create a Tkinter instance
+app = App(root, broker_address, csv_filepath) # Create an App instance
 app.startmqtt() # Start the MQTT connection
 app.mainloop() # Start the window